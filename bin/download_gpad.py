@@ -3,17 +3,23 @@ Download the GPAD suppliers data
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 from datetime import datetime
 import logging
+from operator import itemgetter
 import os
 from pathlib import Path
+import re
 import shutil
+import tempfile
+from typing import BinaryIO
 import zipfile
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from dateutil.relativedelta import relativedelta
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 from helpers import (
     get_data_file_paths,
@@ -23,6 +29,17 @@ from helpers import (
 
 BASE_URL = "https://digital.nhs.uk/data-and-information/publications/statistical/appointments-in-general-practice"
 OUTPUT_FILE = "data/gp_suppliers.csv"
+# Connect and read timeouts in seconds
+REQUEST_TIMEOUT = (5, 60)
+# Only the download cards are needed from the publication page, so avoid
+# building a tree for the rest of it. The class attribute is matched as a
+# whole string while parsing, so look for the card class among any others
+DOWNLOAD_CARD_STRAINER = SoupStrainer(
+    "div", class_=re.compile(r"(^|\s)nhsd-m-download-card(\s|$)")
+)
+# The download card title must mention both "Annex 1" and "CSV",
+# in either order
+ANNEX_1_CSV_TITLE = re.compile(r"(?=.*Annex 1)(?=.*CSV)", re.DOTALL)
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -30,31 +47,48 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Share one session so the landing page and zip file requests reuse
+# pooled connections, and retry transient server errors
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]
+        ),
+    ),
+)
+
 
 def main(month: str, zip_file: str = None):
-    try:
-        download_gpad_zip_file(month, zip_file)
-    except Exception as e:
-        logger.error(f"Error downloading zip file: {e}")
-        raise e
+    # The zip is only needed until it has been extracted, so download it
+    # to a temporary file that is cleaned up as soon as unzipping is done
+    with tempfile.NamedTemporaryFile(dir="tmp", suffix=".zip") as tmp_zip_file:
+        try:
+            download_gpad_zip_file(month, tmp_zip_file, zip_file)
+        except Exception as e:
+            logger.error(f"Error downloading zip file: {e}")
+            raise e
 
-    try:
-        unzip_dir = unzip_gpad_zip_file(month)
-    except Exception as e:
-        logger.error(f"Error unzipping zip file: {e}")
-        raise e
+        try:
+            unzip_dir = unzip_gpad_zip_file(month, tmp_zip_file.name)
+        except Exception as e:
+            logger.error(f"Error unzipping zip file: {e}")
+            raise e
 
     input_file_paths = get_data_file_paths(unzip_dir, month)
     logger.info(f"Found {len(input_file_paths)} data files")
 
     try:
-        data, gp_code_to_name = process_data_files(input_file_paths)
+        columns = process_data_files(input_file_paths)
     except Exception as e:
         logger.error(f"Error processing data file: {e}")
         raise e
 
     try:
-        write_output_file(data, gp_code_to_name)
+        write_output_file(*columns)
     except Exception as e:
         logger.error(f"Error writing output file: {e}")
         raise e
@@ -68,17 +102,19 @@ def main(month: str, zip_file: str = None):
     logger.info(f"Completed processing data for {month}")
 
 
-def download_gpad_zip_file(iso_month: str, zip_file_path: str = None):
+def download_gpad_zip_file(
+    iso_month: str, destination: BinaryIO, zip_file_path: str = None
+):
     """
     Download the GPAD suppliers zip data for a given month
-    from the NHS Digital website
+    from the NHS Digital website into the destination file
     """
     month, year = get_month_and_year_from_iso_month(iso_month)
     url = f"{BASE_URL}/{month}-{year}"
 
     if zip_file_path is None:
         logger.info(f"Finding download link for {iso_month} from {url}")
-        response = requests.get(url)
+        response = session.get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
 
         try:
@@ -92,92 +128,167 @@ def download_gpad_zip_file(iso_month: str, zip_file_path: str = None):
         download_link = zip_file_path
 
     logger.info(f"Downloading zip file from {download_link}")
-    response = requests.get(download_link)
-    response.raise_for_status()
+    with session.get(download_link, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
 
-    with open(f"tmp/{iso_month}.zip", "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-        f.write(response.content)
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            destination.write(chunk)
 
-    logger.info(f"Downloaded zip file to tmp/{iso_month}.zip")
+    destination.flush()
+    logger.info(f"Downloaded zip file to {destination.name}")
 
 
 def get_download_link_from_response(response: requests.Response):
-    soup = BeautifulSoup(response.content, "html.parser")
+    soup = BeautifulSoup(
+        response.content, "html.parser", parse_only=DOWNLOAD_CARD_STRAINER
+    )
     downloads = soup.select("div.nhsd-m-download-card")
 
+    if not downloads:
+        raise Exception("No downloads found.")
+
     for download in downloads:
-        download_title = download.find("p").text
-        if "Annex 1" in download_title and "CSV" in download_title:
+        if ANNEX_1_CSV_TITLE.match(download.find("p").text):
             return download.find("a").get("href")
 
-    if len(downloads) == 0:
-        raise Exception("No downloads found.")
-    else:
-        raise Exception(
-            f"Found {len(downloads)} downloads. No Annex 1 CSV downloads found."
-        )
+    raise Exception(
+        f"Found {len(downloads)} downloads. No Annex 1 CSV downloads found."
+    )
 
 
-def unzip_gpad_zip_file(month: str):
+def unzip_gpad_zip_file(month: str, zip_file_path: str):
     unzip_dir = f"tmp/{month}"
-    if not os.path.exists(unzip_dir):
-        os.makedirs(unzip_dir)
-    with zipfile.ZipFile(f"tmp/{month}.zip", "r") as zip_ref:
-        zip_ref.extractall(unzip_dir)
+    Path(unzip_dir).mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
+        members = zip_ref.infolist()
+
+    # Decompression releases the GIL, so the regional files can be
+    # extracted concurrently
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            executor.submit(extract_zip_member, zip_file_path, member, unzip_dir)
+            for member in members
+        ]
+        for future in futures:
+            future.result()
 
     logger.info(f"Unzipped zip file to {unzip_dir}")
 
     return unzip_dir
 
 
-def process_data_files(input_file_paths: list[str]):
-    data = {}
-    gp_code_to_name = {}
-
-    for input_file_path in input_file_paths:
-        logger.info(f"Processing data file: {input_file_path}")
-        with open(input_file_path, "r") as file:
-            reader = csv.reader(file)
-            for index, row in enumerate(reader):
-                if index == 0:
-                    continue
-
-                gp_code = row[1]
-                gp_name = row[2]
+def extract_zip_member(zip_file_path: str, member: zipfile.ZipInfo, unzip_dir: str):
+    """
+    Extract a single member of a zip file
 
-                appointments_systems = row[3]
-                main_system = get_main_system_from_value(appointments_systems)
+    Each call opens its own handle on the zip file, as ZipFile objects
+    cannot safely be shared between threads
+    """
+    with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
+        zip_ref.extract(member, unzip_dir)
 
-                if gp_code not in data:
-                    data[gp_code] = (appointments_systems, main_system)
 
-                if gp_code not in gp_code_to_name:
-                    gp_code_to_name[gp_code] = gp_name
+def process_data_files(input_file_paths: list[str]):
+    """
+    Process the Practice Level Crosstab files
 
-    # Sort the data alphabetically by GP code
-    # to ensure the output file can be compared more easily over time
-    data = dict(sorted(data.items()))
+    Args:
+        input_file_paths: The paths to the data files
 
-    return data, gp_code_to_name
+    Returns:
+        Parallel lists of GP codes, names and appointments systems,
+        in the order each GP code is first seen
+    """
+    gp_codes = []
+    gp_names = []
+    appointments_systems = []
+    seen = set()
+
+    # Parsing the CSV files is CPU bound, so parse the regional files in
+    # separate processes and merge the results in the original file order
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(process_data_file, input_file_paths)
+
+        for file_gp_codes, file_gp_names, file_appointments_systems in results:
+            for gp_code, gp_name, value in zip(
+                file_gp_codes, file_gp_names, file_appointments_systems
+            ):
+                if gp_code not in seen:
+                    seen.add(gp_code)
+                    gp_codes.append(gp_code)
+                    gp_names.append(gp_name)
+                    appointments_systems.append(value)
+
+    return gp_codes, gp_names, appointments_systems
+
+
+def process_data_file(input_file_path: str):
+    """
+    Process a single Practice Level Crosstab file
 
+    Args:
+        input_file_path: The path to the data file
 
-def write_output_file(data: dict, gp_code_to_name: dict):
+    Returns:
+        Parallel lists of the GP codes, names and appointments systems,
+        in the order each GP code is first seen
+    """
+    gp_codes = []
+    gp_names = []
+    appointments_systems = []
+    seen = set()
+
+    logger.info(f"Processing data file: {input_file_path}")
+    with open(input_file_path, "r") as file:
+        reader = csv.reader(file)
+        # Skip the header row
+        next(reader, None)
+
+        # Only the GP code, GP name and appointments systems columns are
+        # needed, so pick them out in C rather than indexing each row
+        for gp_code, gp_name, value in map(itemgetter(1, 2, 3), reader):
+            if gp_code not in seen:
+                seen.add(gp_code)
+                gp_codes.append(gp_code)
+                gp_names.append(gp_name)
+                appointments_systems.append(value)
+
+    return gp_codes, gp_names, appointments_systems
+
+
+def write_output_file(
+    gp_codes: list[str], gp_names: list[str], appointments_systems: list[str]
+):
     """
     Write the output file
 
     Args:
-        data: A dictionary of GP codes to their appointment systems and main system
-        gp_code_to_name: A dictionary of GP codes to their names
+        gp_codes: The GP codes
+        gp_names: The GP names
+        appointments_systems: The appointments systems values
+
+    The lists are parallel, with each index holding the data for one GP.
     """
-    with open(OUTPUT_FILE, "w") as file:
+    # Sort the data alphabetically by GP code
+    # to ensure the output file can be compared more easily over time
+    order = sorted(range(len(gp_codes)), key=gp_codes.__getitem__)
+
+    # Build each row only as it is written, working out the main system
+    # from the cached get_main_system_from_value along the way
+    rows = (
+        (
+            gp_codes[i],
+            gp_names[i],
+            appointments_systems[i],
+            get_main_system_from_value(appointments_systems[i]),
+        )
+        for i in order
+    )
+
+    with open(OUTPUT_FILE, "w", newline="", buffering=1 << 20) as file:
         writer = csv.writer(file)
         writer.writerow(["GP_ODS_CODE", "GP_NAME", "GP_GPAD_SYSTEMS", "GP_SYSTEM"])
-        for gp_code, (appointment_systems, main_system) in data.items():
-            writer.writerow(
-                [gp_code, gp_code_to_name[gp_code], appointment_systems, main_system]
-            )
+        writer.writerows(rows)
     logger.info(f"Written output file: {OUTPUT_FILE}")
 
 
@@ -185,8 +296,6 @@ def remove_tmp_files(month: str):
     """
     Remove the temporary files for a given month
     """
-    zip_file_path = f"tmp/{month}.zip"
-    Path(zip_file_path).unlink()
     unzip_dir = f"tmp/{month}"
     shutil.rmtree(unzip_dir)
     logger.info(f"Removed temporary files for {month}")
@@ -1,28 +1,38 @@
+from functools import lru_cache
 import os
 
 
+# Month names indexed by month number, with a blank entry so that
+# January is at index 1
+_MONTHS = (
+    "",
+    "january",
+    "february",
+    "march",
+    "april",
+    "may",
+    "june",
+    "july",
+    "august",
+    "september",
+    "october",
+    "november",
+    "december",
+)
+
+
 def month_to_name(month: str):
     """
     Translate a zero-padded month string to a name
     """
     month = int(month)
+    if not 1 <= month <= 12:
+        raise ValueError(f"Invalid month: {month}")
 
-    return {
-        1: "january",
-        2: "february",
-        3: "march",
-        4: "april",
-        5: "may",
-        6: "june",
-        7: "july",
-        8: "august",
-        9: "september",
-        10: "october",
-        11: "november",
-        12: "december",
-    }[month]
+    return _MONTHS[month]
 
 
+@lru_cache
 def get_month_and_year_from_iso_month(iso_month: str):
     """
     Get the month and year from an ISO month string
@@ -55,13 +65,11 @@ def get_data_file_paths(unzip_dir: str, iso_month: str):
     abbreviated_year = year[2:4]  # e.g. 2025 becomes 25
     search_string = f"{abbreviated_month}_{abbreviated_year}.csv"
 
-    return [
-        os.path.join(unzip_dir, f)
-        for f in os.listdir(unzip_dir)
-        if f.endswith(search_string)
-    ]
+    with os.scandir(unzip_dir) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(search_string)]
 
 
+@lru_cache(maxsize=128)
 def get_main_system_from_value(value):
     """
     Get the main GP IT system from a the appointments systems value